@@ -1,6 +1,13 @@
 import sys
 import os
-import json
+import re
+import orjson
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from pathlib import Path
 from clang import cindex
 from clang.cindex import TranslationUnit
 from feedback import reinforcement_loop
@@ -9,12 +16,106 @@ from utils import compile_and_run_project, json_to_cpp
 # Point Python to libclang
 cindex.Config.set_library_file("/opt/homebrew/opt/llvm/lib/libclang.dylib")
 
+# CursorKind values bound once at import time. Comparing raw integers is a
+# single hash probe / int compare per node, instead of an attribute lookup
+# plus CursorKind.__eq__ per branch.
+_VAR_DECL = cindex.CursorKind.VAR_DECL.value
+_FUNCTION_DECL = cindex.CursorKind.FUNCTION_DECL.value
+_CLASS_KINDS = frozenset((
+    cindex.CursorKind.CLASS_DECL.value,
+    cindex.CursorKind.STRUCT_DECL.value,
+    cindex.CursorKind.CLASS_TEMPLATE.value,
+))
+_METHOD_KINDS = frozenset((
+    cindex.CursorKind.CXX_METHOD.value,
+    cindex.CursorKind.CONSTRUCTOR.value,
+    cindex.CursorKind.DESTRUCTOR.value,
+    cindex.CursorKind.FUNCTION_TEMPLATE.value,
+))
+_ENUM_DECL = cindex.CursorKind.ENUM_DECL.value
+_CLASS_TEMPLATE_PARTIAL_SPEC = cindex.CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION.value
+
+# One Index per process, created lazily and reused for every file. Creating
+# an Index re-initializes libclang state; doing that per file is pure waste.
+_INDEX = None
+
+
+def _get_index():
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = cindex.Index.create()
+    return _INDEX
+
+
+def _dump_json(obj) -> str:
+    """Pretty-print results with orjson's C serializer (handles sets)."""
+    return orjson.dumps(
+        obj,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+        default=lambda o: sorted(o) if isinstance(o, set) else str(o),
+    ).decode()
+
+
+# System headers rarely change between runs, so their precompiled form is
+# cached on disk and shared across invocations.
+_PCH_CACHE_DIR = Path.home() / ".cache" / "analyze_cpp"
+_SYSTEM_INCLUDE = re.compile(r'^\s*#\s*include\s*<([^>]+)>', re.MULTILINE)
+
+
+def build_system_pch(filepath, clang_args=None):
+    """Build (or reuse) a PCH covering the file's <...> includes.
+
+    Returns the pch path, or None if clang could not produce one. Keyed by
+    the header set plus flags so a flag change invalidates the cache.
+    """
+    try:
+        source = Path(filepath).read_text(errors="replace")
+    except OSError:
+        return None
+
+    headers = sorted(set(_SYSTEM_INCLUDE.findall(source)))
+    if not headers:
+        return None
+
+    # The key includes the libclang path: a PCH is only readable by the
+    # library that wrote it, so a different dylib must miss the cache.
+    args = clang_args or ["-std=c++17"]
+    lib = cindex.Config.library_file or "libclang"
+    key = hashlib.sha256("\n".join([lib, *headers, *args]).encode()).hexdigest()[:16]
+    pch_path = _PCH_CACHE_DIR / f"preamble_{key}.pch"
+    if pch_path.exists():
+        return str(pch_path)
+
+    _PCH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    combined = _PCH_CACHE_DIR / f"preamble_{key}.hpp"
+    combined.write_text("".join(f"#include <{h}>\n" for h in headers))
+
+    # Build through the same libclang that will consume it. A PCH emitted by
+    # whatever clang++ sits on PATH (Apple clang, typically) is rejected by
+    # the pinned Homebrew dylib on any version skew — and the rejection is a
+    # fatal diagnostic with no file location, so the parses would silently
+    # come back empty rather than fail loudly.
+    try:
+        tu = _get_index().parse(str(combined), args=["-x", "c++-header", *args])
+        if any(d.severity >= cindex.Diagnostic.Error for d in tu.diagnostics):
+            print("⚠️  PCH build failed, parsing without preamble cache")
+            return None
+        tu.save(str(pch_path))
+    except Exception:
+        print("⚠️  PCH build failed, parsing without preamble cache")
+        return None
+    return str(pch_path)
+
 
 def analyze_cpp_file(filepath, clang_args=None):
     """Analyze a single C++ file and extract structure."""
     headers, functions, diagnostics, classes, enums, globals = set(), {}, [], {}, {}, []
 
-    index = cindex.Index.create()
+    # Read the source once as bytes; extents carry byte offsets, so each
+    # extraction below is a single zero-copy slice of this buffer.
+    src = Path(filepath).read_bytes()
+
+    index = _get_index()
     tu = index.parse(
         filepath,
         args=clang_args if clang_args else [
@@ -23,18 +124,30 @@ def analyze_cpp_file(filepath, clang_args=None):
             "-I/Library/Developer/CommandLineTools/usr/include/c++/v1",
             "-isysroot", "/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk"
         ],
-        options=TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+        # We slice function text from the source by line range, so Sema never
+        # needs to check bodies; skipping them (and the detailed preprocessing
+        # record) makes the parse dramatically cheaper on STL-heavy files.
+        options=TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | TranslationUnit.PARSE_INCOMPLETE
     )
 
-    recursiveSearch(tu.cursor, filepath, headers, functions, classes, enums, globals)
+    # Includes come from the lightweight inclusion callbacks rather than the
+    # detailed processing record; depth 1 means directly included by this file.
+    for inc in tu.get_includes():
+        if inc.depth == 1:
+            headers.add(os.path.basename(inc.include.name))
 
-    # Collect diagnostics
+    recursiveSearch(tu.cursor, filepath, src, headers, functions, classes, enums, globals)
+
+    # Collect diagnostics; filter on location before formatting so the many
+    # system-header diagnostics never pay spelling/location stringification.
     severity_map = {0: "Ignored", 1: "Note", 2: "Warning", 3: "Error", 4: "Fatal"}
     for element in tu.diagnostics:
-        if element.location.file and element.location.file.name != filepath:
+        loc = element.location
+        loc_file = loc.file
+        if loc_file is None or loc_file.name != filepath:
             continue
         diagnostics.append(
-            f"{severity_map[element.severity]}: {element.spelling} at {element.location}"
+            f"{severity_map[element.severity]}: {element.spelling} at {loc}"
         )
 
     return {
@@ -47,74 +160,103 @@ def analyze_cpp_file(filepath, clang_args=None):
     }
 
 
-def recursiveSearch(node, filepath, headers, functions, classes, enums, globals, current_class=None, depth=0):
-    """Recursively search AST for code structures."""
-    for child in node.get_children():
-        # Header includes
-        if child.kind == cindex.CursorKind.INCLUSION_DIRECTIVE:
-            if child.location.file and child.location.file.name == filepath:
-                headers.add(child.spelling)
-
-        # Global variables (only at file scope, depth <= 1)
-        elif child.kind == cindex.CursorKind.VAR_DECL and current_class is None and depth <= 1:
-            if child.location.file and child.location.file.name == filepath:
-                with open(child.location.file.name) as f:
-                    lines = f.readlines()
-                    code = "".join(lines[child.extent.start.line - 1: child.extent.end.line])
-                    globals.append(code.strip())
-
-        # Free functions
-        elif child.kind == cindex.CursorKind.FUNCTION_DECL and current_class is None:
-            if child.location.file and child.location.file.name == filepath:
-                with open(child.location.file.name) as f:
-                    lines = f.readlines()
-                    code = "".join(lines[child.extent.start.line - 1: child.extent.end.line])
-                    functions[child.spelling] = code.strip()
-
-        # Classes
-        elif child.kind in (
-            cindex.CursorKind.CLASS_DECL,
-            cindex.CursorKind.STRUCT_DECL,
-            cindex.CursorKind.CLASS_TEMPLATE
-        ):
-            if child.location.file and child.location.file.name == filepath:
-                name = child.spelling if child.spelling else "<anonymous>"
-                with open(child.location.file.name) as f:
-                    lines = f.readlines()
-                    code = "".join(lines[child.extent.start.line - 1: child.extent.end.line])
-                classes[name] = {"definition": code.strip(), "methods": {}}
-                recursiveSearch(child, filepath, headers, functions, classes, enums, globals, current_class=name, depth=depth+1)
+def _collect_decls(node, filepath):
+    """Walk the AST once and return plain (kind, name, start, end, owner) tuples.
+
+    Keeping the traversal loop free of any text handling means the minimum
+    number of libclang calls per visited cursor; everything downstream works
+    on plain Python tuples with no further FFI traffic.
+    """
+    decls = []
+    stack = deque([(node, None, 0)])
+
+    while stack:
+        parent, current_class, depth = stack.pop()
+
+        for child in parent.get_children():
+            # Skip anything that lives outside the target file (system
+            # headers, STL instantiations, ...) without descending into it.
+            # This prunes the bulk of the TU before any dispatch happens.
+            loc = child.location.file
+            if loc is None or loc.name != filepath:
+                continue
+
+            # Each cursor attribute access crosses the ctypes boundary into
+            # libclang, so read kind/extent once per child and reuse.
+            kind = child.kind.value
+
+            # Template specializations replay the primary template's subtree
+            # per instantiation; the primary definition is already captured,
+            # so there is nothing new to collect below them.
+            if kind == _CLASS_TEMPLATE_PARTIAL_SPEC:
+                continue
+
+            if kind in _CLASS_KINDS:
+                extent = child.extent
+                # Intern names: spellings repeat heavily across declarations
+                # and interned keys compare by pointer in the result dicts.
+                name = sys.intern(child.spelling) if child.spelling else "<anonymous>"
+                decls.append((kind, name, extent.start.offset, extent.end.offset, current_class))
+                # Descend with class scope so methods attribute correctly
+                stack.append((child, name, depth + 1))
                 continue
 
-        # Methods
-        elif child.kind in (
-            cindex.CursorKind.CXX_METHOD,
-            cindex.CursorKind.CONSTRUCTOR,
-            cindex.CursorKind.DESTRUCTOR,
-            cindex.CursorKind.FUNCTION_TEMPLATE
-        ):
-            if current_class and child.location.file and child.location.file.name == filepath:
-                with open(child.location.file.name) as f:
-                    lines = f.readlines()
-                    code = "".join(lines[child.extent.start.line - 1: child.extent.end.line])
-                    classes[current_class]["methods"][child.spelling] = code.strip()
-
-        # Enums
-        elif child.kind == cindex.CursorKind.ENUM_DECL:
-            if child.location.file and child.location.file.name == filepath:
-                name = child.spelling if child.spelling else "<anonymous_enum>"
-                with open(child.location.file.name) as f:
-                    lines = f.readlines()
-                    code = "".join(lines[child.extent.start.line - 1: child.extent.end.line])
-                    enums[name] = code.strip()
-
-        # Don't recurse into function bodies to avoid capturing local variables
-        if child.kind != cindex.CursorKind.FUNCTION_DECL:
-            recursiveSearch(child, filepath, headers, functions, classes, enums, globals, current_class, depth+1)
-
-
-def analyze_cpp_project(filepaths, with_ai=False, clang_args=None, run_args=None):
-    """Analyze entire C++ project and optionally optimize with AI."""
+            if (
+                (kind == _VAR_DECL and current_class is None and depth <= 1)
+                or (kind == _FUNCTION_DECL and current_class is None)
+                or (kind in _METHOD_KINDS and current_class)
+                or kind == _ENUM_DECL
+            ):
+                extent = child.extent
+                decls.append((kind, sys.intern(child.spelling or ""), extent.start.offset, extent.end.offset, current_class))
+
+            # Don't descend into function bodies to avoid capturing local variables
+            if kind != _FUNCTION_DECL:
+                stack.append((child, current_class, depth + 1))
+
+    return decls
+
+
+def recursiveSearch(node, filepath, src, headers, functions, classes, enums, globals):
+    """Search the AST for code structures and fill the result containers."""
+    # Partition the collected decls by kind once, then run one tight loop per
+    # group instead of re-dispatching on kind for every decl.
+    by_kind = {}
+    for decl in _collect_decls(node, filepath):
+        by_kind.setdefault(decl[0], []).append(decl)
+
+    def group(kinds):
+        for k in kinds:
+            yield from by_kind.get(k, ())
+
+    def text(start, end):
+        return src[start:end].decode("utf-8", "replace").strip()
+
+    # Classes first so method attribution below is a plain dict lookup.
+    for _, name, start, end, _ in group(_CLASS_KINDS):
+        classes[name] = {"definition": text(start, end), "methods": {}}
+
+    for _, _, start, end, _ in by_kind.get(_VAR_DECL, ()):
+        globals.append(text(start, end))
+
+    for _, name, start, end, _ in by_kind.get(_FUNCTION_DECL, ()):
+        functions[name] = text(start, end)
+
+    for _, name, start, end, _ in by_kind.get(_ENUM_DECL, ()):
+        enums[name if name else "<anonymous_enum>"] = text(start, end)
+
+    for _, name, start, end, owner in group(_METHOD_KINDS):
+        if owner in classes:
+            classes[owner]["methods"][name] = text(start, end)
+
+
+def analyze_cpp_project(filepaths, with_ai=False, clang_args=None, run_args=None, cwd=None):
+    """Analyze entire C++ project and optionally optimize with AI.
+
+    cwd, when given, is where benchmarked programs execute (so relative
+    data paths in run_args resolve) — passed through to the compile/run
+    helpers instead of os.chdir'ing process-global state.
+    """
     project_results = {
         "headers": set(),
         "functions": {},
@@ -124,28 +266,48 @@ def analyze_cpp_project(filepaths, with_ai=False, clang_args=None, run_args=None
         "diagnostics": [],
     }
 
-    # Analyze each file
-    for fp in filepaths:
-        if not (fp.endswith(".cpp") or fp.endswith(".cc")):
-            continue  # skip headers
-        
+    cpp_files = [fp for fp in filepaths if fp.endswith(".cpp") or fp.endswith(".cc")]
+
+    # Share one precompiled header across all parses; re-parsing <iostream>
+    # and friends per file dominates wall time otherwise. Only done when the
+    # caller supplies explicit flags, so the PCH is built with the same args.
+    parse_args = clang_args
+    if clang_args and cpp_files:
+        pch_path = build_system_pch(cpp_files[0], clang_args)
+        if pch_path:
+            parse_args = ["-include-pch", pch_path] + clang_args
+
+    # Analyze files in parallel: each analysis is CPU-bound inside libclang
+    # (outside the GIL) and files are independent, so this scales with cores.
+    # The baseline compile+run only shells out to clang and the binary, so it
+    # overlaps with the analysis phase on a side thread.
+    for fp in cpp_files:
         print(f"📄 Analyzing: {fp}")
-        results = analyze_cpp_file(fp, clang_args)
-        
-        project_results["headers"].update(results["headers"])
-        project_results["functions"].update(results["functions"])
-        project_results["classes"].update(results["classes"])
-        project_results["enums"].update(results["enums"])
-        project_results["globals"].extend(results["globals"])
-        project_results["diagnostics"].extend(results["diagnostics"])
-
-    # Convert headers set to sorted list for JSON serialization
-    project_results["headers"] = sorted(project_results["headers"])
-
-    # Compile and benchmark baseline
-    print("\n🔨 Compiling baseline...")
-    baseline = compile_and_run_project(filepaths, run_args=run_args, clang_args=clang_args)
-    
+    print("🔨 Compiling baseline...")
+
+    with ThreadPoolExecutor(max_workers=1) as baseline_ex:
+        baseline_future = baseline_ex.submit(
+            compile_and_run_project, filepaths, run_args=run_args, clang_args=clang_args, cwd=cwd
+        )
+
+        if len(cpp_files) > 1:
+            with ProcessPoolExecutor(max_workers=min(len(cpp_files), os.cpu_count() or 1)) as ex:
+                all_results = list(ex.map(partial(analyze_cpp_file, clang_args=parse_args), cpp_files))
+        else:
+            all_results = [analyze_cpp_file(fp, parse_args) for fp in cpp_files]
+
+        baseline = baseline_future.result()
+
+    # Merge in bulk: one allocation at final size per container instead of
+    # incremental update/extend growth across files.
+    # (headers end up a sorted list for JSON serialization)
+    project_results["headers"] = sorted(set().union(*(r["headers"] for r in all_results)) if all_results else set())
+    project_results["functions"] = {k: v for r in all_results for k, v in r["functions"].items()}
+    project_results["classes"] = {k: v for r in all_results for k, v in r["classes"].items()}
+    project_results["enums"] = {k: v for r in all_results for k, v in r["enums"].items()}
+    project_results["globals"] = list(chain.from_iterable(r["globals"] for r in all_results))
+    project_results["diagnostics"] = list(chain.from_iterable(r["diagnostics"] for r in all_results))
+
     if baseline is not None:
         print(f"⏱️  Baseline runtime: {baseline:.6f}s")
     else:
@@ -160,7 +322,8 @@ def analyze_cpp_project(filepaths, with_ai=False, clang_args=None, run_args=None
             baseline,
             iterations=5,
             clang_args=clang_args,
-            run_args=run_args
+            run_args=run_args,
+            cwd=cwd
         )
         project_results["ai_feedback"] = {
             "best_json": best_json,
@@ -204,12 +367,12 @@ if __name__ == "__main__":
             "headers": final_json.get("headers", []),
             "diagnostics": final_json.get("diagnostics", [])
         }
-        print(json.dumps(safe_feedback, indent=2))
+        print(_dump_json(safe_feedback))
     else:
-        print(json.dumps({
+        print(_dump_json({
             "headers": results["headers"],
             "num_functions": len(results["functions"]),
             "num_classes": len(results["classes"]),
             "num_enums": len(results["enums"]),
             "diagnostics": results["diagnostics"]
-        }, indent=2))
\ No newline at end of file
+        }))
\ No newline at end of file
@@ -1,18 +1,195 @@
 from groq import Groq
-import os, json
+import functools
+import httpx
+import os, json, copy, hashlib, re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from pathlib import Path
 from dotenv import load_dotenv
-from utils import json_to_cpp, compile_and_run_project
+from pydantic import BaseModel
+from utils import json_to_cpp_source, compile_and_run_project, compile_source, benchmark_binary
 
-load_dotenv()
-api_key = os.getenv("GROQ_API_KEY")
-client = Groq(api_key=api_key)
 
-def reinforcement_loop(label, original_json, baseline_time, iterations=3, clang_args=None, run_args=None):
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """Groq client, built lazily on first use and reused for the process.
+
+    Import-time construction would parse .env and open connection state in
+    the server master before gunicorn/uvicorn fork; lazy init gives each
+    worker its own client and keeps importing this module cheap.
+    """
+    load_dotenv()
+    # Explicit pooled transport: keep-alive across the loop's serial calls
+    # (saves a TLS handshake per iteration) and enough connections for the
+    # concurrent per-iteration proposals. Plain HTTP/1.1 — http2=True would
+    # make httpx's optional h2 package a hard dependency for no extra win
+    # here, since the pool already covers the handshake cost.
+    http_client = httpx.Client(
+        transport=httpx.HTTPTransport(retries=2),
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        timeout=60.0,
+    )
+    return Groq(api_key=os.getenv("GROQ_API_KEY"), http_client=http_client)
+
+# Model responses keyed by prompt hash; identical code states (common when
+# iterations reject a candidate and retry) skip the network round-trip.
+# Backed by a small on-disk store so re-runs of the same project (server
+# restarts, CI) also hit the cache across processes.
+_response_cache = {}
+_AI_CACHE_DIR = Path.home() / ".cache" / "cpp-opt-assistant"
+
+# pid + a process-local monotonic counter is unique enough for scratch names
+# and costs nothing (count.__next__ is atomic in CPython, so the parallel
+# compile workers can share it).
+_work_ids = count()
+
+# Main model for quality proposals; the instant tier answers in a fraction of
+# the time and is good enough for the cheap first exploration pass.
+MODEL = "openai/gpt-oss-120b"
+FAST_MODEL = "llama-3.1-8b-instant"
+
+
+class ClassChange(BaseModel):
+    """Partial class rewrite: a new definition and/or individual methods."""
+    definition: str | None = None
+    methods: dict[str, str] = {}
+
+
+class OptimizedCode(BaseModel):
+    """Shape of one optimization proposal — only the items the model changed."""
+    functions: dict[str, str] = {}
+    classes: dict[str, ClassChange] = {}
+    headers: list[str] = []
+
+
+# Strips comments and collapses whitespace before hashing candidate source:
+# proposals that differ only in commentary or formatting compile to the same
+# binary, so they should hit the same runtime-cache entry.
+_SRC_NORM = re.compile(rb"//[^\n]*|/\*.*?\*/|\s+", re.S)
+
+# Schema-constrained decoding: the server enforces this shape while sampling,
+# so malformed proposals (the old json_object mode only guaranteed *some*
+# JSON) stop burning a compile attempt or a whole model call.
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "optimized_code",
+        "schema": OptimizedCode.model_json_schema(),
+    },
+}
+
+
+def _load_cached_response(key):
+    if key in _response_cache:
+        return _response_cache[key]
+    path = _AI_CACHE_DIR / f"{key}.json"
+    try:
+        content = path.read_text()
+    except OSError:
+        return None
+    _response_cache[key] = content
+    return content
+
+
+def _store_response(key, content):
+    _response_cache[key] = content
+    try:
+        _AI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        (_AI_CACHE_DIR / f"{key}.json").write_text(content)
+    except OSError:
+        pass  # cache is best-effort; never fail the loop over it
+
+def _fetch_proposal(system_msg, user_msg, temperature, model=MODEL):
+    """Request one optimization proposal; returns raw JSON text or None."""
+    cache_key = hashlib.blake2b(
+        f"{model}|{temperature}|{user_msg}".encode(), digest_size=16
+    ).hexdigest()
+    content = _load_cached_response(cache_key)
+    if content is not None:
+        print("    (cached model response)")
+        return content
+
+    try:
+        # Stream the completion so tokens are consumed as Groq emits
+        # them instead of blocking until the full message lands.
+        response = get_client().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_msg},
+                {"role": "user", "content": user_msg}
+            ],
+            temperature=temperature,
+            response_format=_RESPONSE_FORMAT,
+            stream=True
+        )
+        parts = []
+        for chunk in response:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+    except Exception as e:
+        print(f"❌ API Error: {e}")
+        return None
+
+    content = "".join(parts).strip()
+    _store_response(cache_key, content)
+    return content
+
+
+def _merge_changes(best_json, changes):
+    """Apply the model's partial changes on top of a copy of the best state."""
+    # Deep copy: several candidates per iteration derive from the same best
+    # state, so merges must not mutate shared nested dicts.
+    candidate_json = copy.deepcopy(best_json)
+
+    # Merge Functions
+    if "functions" in changes:
+        print(f"    AI optimized {len(changes['functions'])} functions")
+        for name, code in changes["functions"].items():
+            candidate_json["functions"][name] = code
+
+    # Merge Classes
+    if "classes" in changes:
+        print(f"    AI optimized {len(changes['classes'])} classes")
+        if "classes" not in candidate_json:
+            candidate_json["classes"] = {}
+
+        for class_name, class_data in changes["classes"].items():
+            if class_name in candidate_json["classes"]:
+                # Overwrite the main class definition (strips out old inline methods)
+                if "definition" in class_data:
+                    candidate_json["classes"][class_name]["definition"] = class_data["definition"]
+                # Overwrite specific methods if provided
+                if "methods" in class_data:
+                    for method_name, method_code in class_data["methods"].items():
+                        candidate_json["classes"][class_name]["methods"][method_name] = method_code
+            else:
+                # If the AI generated a completely new class structure
+                candidate_json["classes"][class_name] = class_data
+
+    # Merge new headers if needed
+    if "headers" in changes:
+        old_h = set(candidate_json.get("headers", []))
+        new_h = set(changes["headers"])
+        candidate_json["headers"] = list(old_h.union(new_h))
+
+    return candidate_json
+
+
+def reinforcement_loop(label, original_json, baseline_time, iterations=3, clang_args=None, run_args=None, candidates_per_iter=3, pgo=False, fast_first_pass=True, cwd=None):
     print(f"Baseline runtime: {baseline_time:.6f}s")
     
     best_json = original_json.copy()
     best_time = baseline_time if baseline_time else float('inf')
 
+    # Runtimes keyed by candidate hash: the model frequently re-proposes a
+    # rejected candidate, and a cache hit skips the whole compile+run cycle.
+    runtime_cache = {}
+
+    # Serialized once and refreshed only when best_json actually changes;
+    # iterations that reject all candidates reuse the cached string.
+    best_serialized = json.dumps(best_json, separators=(",", ":"))
+
     for i in range(iterations):
         print(f"\n--- Iteration {i+1} ---")
 
@@ -30,69 +207,103 @@ def reinforcement_loop(label, original_json, baseline_time, iterations=3, clang_
             f"Current Runtime: {best_time:.6f}s\n"
             "Identify bottlenecks (loops, memory layout, AoS vs SoA) and optimize them.\n"
             "Use -O3 friendly code (std::move, references, SIMD-friendly layouts).\n\n"
-            f"Code State:\n{json.dumps(best_json)}"
+            f"Code State:\n{best_serialized}"
         )
 
-        try:
-            response = client.chat.completions.create(
-                model="openai/gpt-oss-120b",
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_msg}
-                ],
-                temperature=0.2, # Low temp = more valid JSON
-                response_format={"type": "json_object"}
-            )
-            
-            # 3. Merge Strategy (Now handles both functions and classes)
-            changes = json.loads(response.choices[0].message.content.strip())
-            candidate_json = best_json.copy()
-            
-            # Merge Functions
-            if "functions" in changes:
-                print(f"    AI optimized {len(changes['functions'])} functions")
-                for name, code in changes["functions"].items():
-                    candidate_json["functions"][name] = code
-            
-            # Merge Classes
-            if "classes" in changes:
-                print(f"    AI optimized {len(changes['classes'])} classes")
-                if "classes" not in candidate_json:
-                    candidate_json["classes"] = {}
-                    
-                for class_name, class_data in changes["classes"].items():
-                    if class_name in candidate_json["classes"]:
-                        # Overwrite the main class definition (strips out old inline methods)
-                        if "definition" in class_data:
-                            candidate_json["classes"][class_name]["definition"] = class_data["definition"]
-                        # Overwrite specific methods if provided
-                        if "methods" in class_data:
-                            for method_name, method_code in class_data["methods"].items():
-                                candidate_json["classes"][class_name]["methods"][method_name] = method_code
-                    else:
-                        # If the AI generated a completely new class structure
-                        candidate_json["classes"][class_name] = class_data
-            
-            # Merge new headers if needed
-            if "headers" in changes:
-                old_h = set(candidate_json.get("headers", []))
-                new_h = set(changes["headers"])
-                candidate_json["headers"] = list(old_h.union(new_h))
-
-        except Exception as e:
-            print(f"❌ JSON Error: {e}")
+        # 3. Fetch several proposals concurrently. Each iteration still
+        # depends on the previous best, but within an iteration the API
+        # calls are independent network waits, so they overlap; varied
+        # temperatures make the candidates explore different rewrites.
+        # First iteration runs on the instant tier for a cheap exploration
+        # pass; anything later (refining an actual improvement) gets the
+        # stronger model.
+        model = FAST_MODEL if fast_first_pass and i == 0 else MODEL
+        temps = [0.2 + 0.3 * k for k in range(candidates_per_iter)]
+        with ThreadPoolExecutor(max_workers=len(temps)) as ex:
+            contents = list(ex.map(
+                lambda t: _fetch_proposal(system_msg, user_msg, t, model), temps
+            ))
+
+        candidates = []
+        for content in contents:
+            if content is None:
+                continue
+            try:
+                # Validate against the same schema the server decoded with
+                # (pydantic's core is Rust-backed, so this is cheap);
+                # exclude_unset keeps the merge partial — absent keys stay
+                # untouched in the best state.
+                changes = OptimizedCode.model_validate_json(content).model_dump(exclude_unset=True)
+                candidates.append(_merge_changes(best_json, changes))
+            except Exception as e:
+                print(f"❌ JSON Error: {e}")
+
+        if not candidates:
             continue
 
-        # 4. Test
-        cpp_file = json_to_cpp(candidate_json, f"iter_{i+1}.cpp")
-        runtime = compile_and_run_project([cpp_file], run_args=run_args, clang_args=clang_args)
-        
-        if runtime is not None and runtime < best_time:
-            print(f" Improvement! {best_time:.6f}s -> {runtime:.6f}s")
-            best_time = runtime
-            best_json = candidate_json
-        else:
-            print(f"⚠️ No improvement ({runtime}s)")
-            if os.path.exists(cpp_file): os.remove(cpp_file)
+        # 4. Render every candidate, keying the cache on the emitted C++
+        # normalized for comments/whitespace: different JSON shapes (or the
+        # same rewrite with fresh commentary) frequently codegen to an
+        # equivalent program, and then the benchmark result is already known.
+        prepared = []
+        for candidate_json in candidates:
+            source = json_to_cpp_source(candidate_json)
+            prepared.append((
+                candidate_json,
+                source,
+                hashlib.blake2b(_SRC_NORM.sub(b" ", source.encode()), digest_size=16).digest()
+            ))
+
+        # Compile uncached candidates in parallel (clang runs outside the
+        # GIL); the timing runs below stay serial so they never share cores.
+        # PGO interleaves a training run with its compiles, so it keeps the
+        # sequential path.
+        exes = {}
+        if not pgo:
+            # Dedup on the normalized-source key here too: equivalent
+            # candidates in one iteration should compile once, and the later
+            # copies take the runtime-cache branch below.
+            seen_keys = set()
+            to_compile = []
+            for idx, (_, src, key) in enumerate(prepared):
+                if key not in runtime_cache and key not in seen_keys:
+                    seen_keys.add(key)
+                    to_compile.append((idx, src))
+            if to_compile:
+                with ThreadPoolExecutor(max_workers=len(to_compile)) as ex:
+                    exes = dict(ex.map(
+                        lambda job: (job[0], compile_source(job[1], clang_args, exe_path=f"cand_{os.getpid()}_{next(_work_ids)}")),
+                        to_compile
+                    ))
+
+        for idx, (candidate_json, source, cand_key) in enumerate(prepared):
+            if cand_key in runtime_cache:
+                print("    (identical source already benchmarked, reusing runtime)")
+                runtime = runtime_cache[cand_key]
+            elif pgo:
+                runtime = compile_and_run_project([], source=source, run_args=run_args, clang_args=clang_args, pgo=True, cwd=cwd)
+                runtime_cache[cand_key] = runtime
+            else:
+                exe = exes.get(idx)
+                # A candidate 3x slower than the best can't win; cut its
+                # timing short instead of running out the full repetitions.
+                abort_over = 3 * best_time if best_time != float('inf') else None
+                runtime = benchmark_binary(exe, run_args=run_args, abort_over=abort_over, cwd=cwd) if exe else None
+                runtime_cache[cand_key] = runtime
+
+            if runtime is not None and runtime < best_time:
+                print(f" Improvement! {best_time:.6f}s -> {runtime:.6f}s")
+                best_time = runtime
+                best_json = candidate_json
+                best_serialized = json.dumps(best_json, separators=(",", ":"))
+            else:
+                print(f"⚠️ No improvement ({runtime}s)")
+
+        # Every compiled binary this iteration is done being measured; remove
+        # them all rather than letting the loop pile binaries up in the
+        # scratch dir until process exit.
+        for exe in exes.values():
+            if exe and os.path.exists(exe):
+                os.remove(exe)
 
     return best_json, best_time
\ No newline at end of file
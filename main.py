@@ -1,7 +1,13 @@
+import asyncio
 import os
+import shutil
 import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+import aiofiles
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import FileResponse
 from analyze import analyze_cpp_project
@@ -9,6 +15,13 @@ from utils import json_to_cpp
 
 app = FastAPI(title="C++ Optimizer API", description="Optimize C++ projects using AI")
 
+# Classification by extension is one splitext + one hash probe per file,
+# instead of str.endswith scanning a suffix tuple (twice, for the old
+# source-but-not-header check — the sets are disjoint, so one probe decides).
+_SRC_EXTS = frozenset({".cpp", ".cc", ".c", ".cxx"})
+_HDR_EXTS = frozenset({".h", ".hpp", ".hxx", ".hh", ".H"})
+_SKIP_FILES = frozenset({"Makefile", "CMakeLists.txt", "README", "LICENSE"})
+
 from fastapi.middleware.cors import CORSMiddleware
 
 # Allow the React frontend to communicate with the API
@@ -31,17 +44,22 @@ def process_project(project_root: Path, filepaths: list, include_paths: list, ru
         "-isysroot", "/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk",
     ]
     
-    # Add custom include paths
-    for inc in include_paths:
-        clang_args.append(f"-I{inc}")
-    
-    # Add project root and all subdirectories as include paths
-    clang_args.append(f"-I{project_root}")
-    for root, dirs, _ in os.walk(project_root):
+    # Include paths: the user's dirs keep first priority, then the project
+    # root, then any subdirectory that actually contains a header — which
+    # keeps bare `#include "foo.h"` working for nested layouts without one
+    # flag per data/build directory. clang scans every -I directory for each
+    # #include, so the curated list is realpath-canonicalized (collapsing
+    # symlinked duplicates), deduped in order, and the discovered dirs go
+    # shallow-first so common headers resolve early.
+    header_dirs = []
+    for root, dirs, files in os.walk(project_root):
         dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ['__pycache__', '__MACOSX']]
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            clang_args.append(f"-I{dir_path}")
+        if root != str(project_root) and any(os.path.splitext(f)[1] in _HDR_EXTS for f in files):
+            header_dirs.append(os.path.realpath(root))
+    header_dirs.sort(key=lambda p: p.count(os.sep))
+
+    candidates = [os.path.realpath(p) for p in include_paths] + [os.path.realpath(project_root)] + header_dirs
+    clang_args.extend(f"-I{p}" for p in dict.fromkeys(p for p in candidates if os.path.isdir(p)))
     
     print(f"\n{'='*60}")
     print(f"🔧 Compiling {len(filepaths)} C++ file(s)")
@@ -62,20 +80,16 @@ def process_project(project_root: Path, filepaths: list, include_paths: list, ru
             detail=f"Working directory '{work_dir}' not found in project"
         )
     
-    # Change to execution directory
-    original_dir = os.getcwd()
-    os.chdir(execution_dir)
-    
-    try:
-        results = analyze_cpp_project(
-            filepaths,
-            with_ai=True,
-            clang_args=clang_args,
-            run_args=run_args if not skip_execution else None
-        )
-        return results
-    finally:
-        os.chdir(original_dir)
+    # Run programs from execution_dir via cwd= on the subprocesses rather
+    # than os.chdir: chdir is process-global, so it would serialize (and
+    # corrupt) concurrent requests working on different projects.
+    return analyze_cpp_project(
+        filepaths,
+        with_ai=True,
+        clang_args=clang_args,
+        run_args=run_args if not skip_execution else None,
+        cwd=str(execution_dir)
+    )
 
 
 @app.get("/")
@@ -123,50 +137,96 @@ async def optimize_zip(
 
     with tempfile.TemporaryDirectory() as tmpdirname:
         project_root = Path(tmpdirname)
-        source_exts = (".cpp", ".cc", ".c", ".cxx")
-        
+
         print(f"\n📦 Uploading project to: {tmpdirname}")
         print(f"📦 Extracting ZIP: {project_zip.filename}")
         
-        # Save and extract ZIP
+        # Save and extract ZIP. Stream in 1 MB chunks rather than buffering
+        # the whole archive in memory first — project ZIPs with data files
+        # can be large, and this overlaps the disk write with the receive.
+        # aiofiles keeps the writes off the event loop, so other requests
+        # aren't stalled behind a slow disk.
         zip_path = project_root / "upload.zip"
-        with open(zip_path, "wb") as f:
-            f.write(await project_zip.read())
+        async with aiofiles.open(zip_path, "wb") as f:
+            while chunk := await project_zip.read(1 << 20):
+                await f.write(chunk)
         
+        # Find all files
+        filepaths = []
+        all_files = []
+
+        # One pass over the ZIP central directory: skip junk and classify
+        # before anything touches disk. The central directory is already in
+        # memory, so this replaces extracting everything and then os.walk-ing
+        # the tree (a second full traversal plus readdir/stat per entry).
+        # Data files still get extracted — programs run with run_args expect
+        # their inputs on disk next to the sources.
+        root_resolved = project_root.resolve()
+        kept = []
         try:
             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(project_root)
+                for info in zip_ref.infolist():
+                    if info.is_dir():
+                        continue
+                    rel_path = info.filename
+                    parts = rel_path.split('/')
+                    file = parts[-1]
+                    if (file.startswith('.') or file.startswith('._') or file in _SKIP_FILES
+                            or any(d.startswith('.') or d in ('__pycache__', '__MACOSX') for d in parts[:-1])):
+                        continue
+
+                    # extractall sanitizes absolute and .. member names; the
+                    # manual open-and-write below must do its own zip-slip
+                    # check, so resolve the target and require it to stay
+                    # inside the request tempdir.
+                    target = (project_root / rel_path).resolve()
+                    if not target.is_relative_to(root_resolved):
+                        print(f"  ⚠️ {rel_path} (escapes project root - skipped)")
+                        continue
+
+                    kept.append((info, target))
+                    all_files.append(rel_path)
+
+                    ext = os.path.splitext(file)[1]
+                    if ext in _SRC_EXTS:
+                        filepaths.append(str(target))
+                        print(f"   {rel_path} (will compile)")
+                    elif ext in _HDR_EXTS:
+                        print(f"  📋 {rel_path} (header - will be available for #include)")
+                    else:
+                        print(f"  📄 {rel_path}")
         except zipfile.BadZipFile:
             raise HTTPException(status_code=400, detail="Invalid ZIP file")
-        
+
+        # Pre-create every target directory in one pass. ZipFile.extract
+        # re-validates the whole directory chain per member; doing it once
+        # up front leaves the workers with nothing but open-and-write.
+        for d in sorted({target.parent for _, target in kept}):
+            os.makedirs(d, exist_ok=True)
+
+        # Extract the kept entries in parallel. Inflate runs in zlib's C code
+        # and releases the GIL, so threads scale; each thread gets its own
+        # ZipFile handle because reads on a shared handle aren't thread-safe.
+        tls = threading.local()
+        handles = []
+
+        def _extract_one(job):
+            info, target = job
+            zf = getattr(tls, "zf", None)
+            if zf is None:
+                zf = tls.zf = zipfile.ZipFile(zip_path)
+                handles.append(zf)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 16)
+
+        if kept:
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+                list(ex.map(_extract_one, kept))
+        for zf in handles:
+            zf.close()
+
         os.remove(zip_path)
         
-        # Find all files
-        filepaths = []
-        all_files = []
-        
-        header_exts = (".h", ".hpp", ".hxx", ".hh", ".H")
-        skip_files = ("Makefile", "CMakeLists.txt", "README", "LICENSE")
-        
-        for root, dirs, files_in_dir in os.walk(project_root):
-            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ['__pycache__', '__MACOSX']]
-            
-            for file in files_in_dir:
-                if file.startswith('.') or file.startswith('._') or file in skip_files:
-                    continue
-                    
-                file_path = Path(root) / file
-                rel_path = file_path.relative_to(project_root)
-                all_files.append(str(rel_path))
-                
-                if file.endswith(source_exts) and not file.endswith(header_exts):
-                    filepaths.append(str(file_path))
-                    print(f"   {rel_path} (will compile)")
-                elif file.endswith(header_exts):
-                    print(f"  📋 {rel_path} (header - will be available for #include)")
-                else:
-                    print(f"  📄 {rel_path}")
-        
         if not filepaths:
             raise HTTPException(
                 status_code=400,
@@ -184,10 +244,11 @@ async def optimize_zip(
             raise HTTPException(status_code=500, detail="AI optimization failed")
 
         final_json = results["ai_feedback"]["best_json"]
-        cpp_file = json_to_cpp(final_json, filename="project_combined.cpp")
-
-        with open(cpp_file, "a") as f:
-            f.write("\n\n// Optimized by Aadesh's C++ AI Assistant")
+        cpp_file = json_to_cpp(
+            final_json,
+            filename="project_combined.cpp",
+            footer="\n\n// Optimized by Aadesh's C++ AI Assistant",
+        )
 
         print(f"\n Optimization complete! Generated: {cpp_file}\n")
         return FileResponse(cpp_file, media_type="text/x-c", filename="project_combined.cpp")
@@ -203,9 +264,7 @@ async def optimize_files(
     """
     **Upload individual files** (Good for quick testing of single files)
     """
-    
-    source_exts = (".cpp", ".cc", ".c", ".cxx")
-    
+
     include_paths = [p.strip() for p in include_dirs.split(",") if p.strip()]
     run_args = [a.strip() for a in program_args.split(",") if a.strip()]
 
@@ -215,23 +274,30 @@ async def optimize_files(
 
     with tempfile.TemporaryDirectory() as tmpdirname:
         project_root = Path(tmpdirname)
-        filepaths = []
-        
+
         print(f"\n📦 Uploading files to: {tmpdirname}")
-        
+
+        # Validate everything before writing anything.
         for upload in cpp_files:
-            if not upload.filename.endswith(source_exts):
+            if os.path.splitext(upload.filename)[1] not in _SRC_EXTS:
                 raise HTTPException(
                     status_code=400,
                     detail=f"File '{upload.filename}' must be a C++ source file (.cpp, .cc, .c, .cxx)"
                 )
-            
+
+        # Save all uploads concurrently: each coroutine streams its file to
+        # disk in chunks through aiofiles, so network receive and disk writes
+        # overlap across files and wall time is the slowest upload, not the
+        # sum of them.
+        async def _save(upload):
             file_path = project_root / upload.filename
-            with open(file_path, "wb") as f:
-                f.write(await upload.read())
-            
-            filepaths.append(str(file_path))
+            async with aiofiles.open(file_path, "wb") as f:
+                while chunk := await upload.read(1 << 20):
+                    await f.write(chunk)
             print(f"  ✅ {upload.filename}")
+            return str(file_path)
+
+        filepaths = list(await asyncio.gather(*(_save(u) for u in cpp_files)))
 
         try:
             results = process_project(project_root, filepaths, include_paths, run_args, None, skip_execution)
@@ -244,10 +310,11 @@ async def optimize_files(
             raise HTTPException(status_code=500, detail="AI optimization failed")
 
         final_json = results["ai_feedback"]["best_json"]
-        cpp_file = json_to_cpp(final_json, filename="project_combined.cpp")
-
-        with open(cpp_file, "a") as f:
-            f.write("\n\n// Optimized by Aadesh's C++ AI Assistant")
+        cpp_file = json_to_cpp(
+            final_json,
+            filename="project_combined.cpp",
+            footer="\n\n// Optimized by Aadesh's C++ AI Assistant",
+        )
 
         print(f"\n Optimization complete! Generated: {cpp_file}\n")
         return FileResponse(cpp_file, media_type="text/x-c", filename="project_combined.cpp")
\ No newline at end of file